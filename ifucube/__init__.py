@@ -1,3 +1,7 @@
 from .wavelength import *
+from .dq import *
+from .arithmetic import *
+from .datacache import *
 from .ifucube import *
-from .ifucubelist import *
\ No newline at end of file
+from .ifucubelist import *
+from .footprint import *
@@ -0,0 +1,376 @@
+"""Lazy IFUCube arithmetic evaluated in fused chunks along the spectral axis"""
+
+import logging
+import operator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy import units as u
+
+from .datacache import pin_data
+
+__all__ = ['CubeExpression', 'CubeTerm', 'ConstantTerm', 'error_to_variance']
+
+logger = logging.getLogger('ifucube')
+
+# Target size of the temporaries created while evaluating one chunk.
+DEFAULT_CHUNK_BYTES = 16 * 1024**2
+
+# How the ERROR extension of a data configuration stores the uncertainty.
+ERROR_TYPES = ('stddev', 'variance', 'ivar')
+
+
+def error_to_variance(error, error_type):
+    """
+    Convert an uncertainty array to variance.
+
+    :param error: Uncertainty array as stored in the file
+    :param error_type: One of 'stddev', 'variance' or 'ivar'
+    :return: Variance array
+    """
+    error = np.asarray(error)
+
+    if error_type == 'stddev':
+        return np.square(error, dtype=np.result_type(error.dtype, np.float32))
+    elif error_type == 'variance':
+        return error
+    elif error_type == 'ivar':
+        # Zero inverse variance means no information, i.e. infinite variance.
+        with np.errstate(divide='ignore'):
+            return 1.0 / error
+    else:
+        raise ValueError('Unknown error type {}, expected one of {}'.format(error_type, ERROR_TYPES))
+
+
+class CubeExpression:
+    """
+    Node of a lazy expression built from IFUCube arithmetic.
+
+    Nothing is computed until evaluate() is called, which walks the
+    expression once per chunk of spectral planes so the only full size
+    arrays are the result and its variance.  Variances are propagated to
+    first order assuming the operands are uncorrelated.
+    """
+
+    # Make numpy arrays and Quantities defer to our reflected operators.
+    __array_ufunc__ = None
+
+    @property
+    def shape(self):
+        raise NotImplementedError()
+
+    @property
+    def unit(self):
+        raise NotImplementedError()
+
+    @property
+    def dtype(self):
+        raise NotImplementedError()
+
+    @property
+    def has_variance(self):
+        raise NotImplementedError()
+
+    def cubes(self):
+        """All the IFUCubes the expression reads from."""
+        return []
+
+    def _chunk(self, sl):
+        """
+        Compute the values and variance (or None) for the planes in the slice.
+
+        :param sl: Slice along the first (spectral) axis
+        :return: (values, variance)
+        """
+        raise NotImplementedError()
+
+    #
+    # Operators
+    #
+
+    def __add__(self, other):
+        return BinaryOp(operator.add, self, as_expression(other))
+
+    def __radd__(self, other):
+        return BinaryOp(operator.add, as_expression(other), self)
+
+    def __sub__(self, other):
+        return BinaryOp(operator.sub, self, as_expression(other))
+
+    def __rsub__(self, other):
+        return BinaryOp(operator.sub, as_expression(other), self)
+
+    def __mul__(self, other):
+        return BinaryOp(operator.mul, self, as_expression(other))
+
+    def __rmul__(self, other):
+        return BinaryOp(operator.mul, as_expression(other), self)
+
+    def __truediv__(self, other):
+        return BinaryOp(operator.truediv, self, as_expression(other))
+
+    def __rtruediv__(self, other):
+        return BinaryOp(operator.truediv, as_expression(other), self)
+
+    def __neg__(self):
+        return BinaryOp(operator.mul, ConstantTerm(-1), self)
+
+    #
+    # Evaluation
+    #
+
+    def _default_chunk_planes(self):
+        plane_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        return max(1, DEFAULT_CHUNK_BYTES // max(1, plane_bytes))
+
+    def evaluate(self, chunk_planes=None, threads=None, out=None, out_variance=None):
+        """
+        Evaluate the expression and return a new IFUCube.
+
+        :param chunk_planes: Number of spectral planes per chunk, by default about 16 MB worth
+        :param threads: Number of threads to evaluate chunks with, None to run serially
+        :param out: Optional array (e.g. np.memmap) to write the data to
+        :param out_variance: Optional array to write the variance to
+        :return: IFUCube with the data, unit and variance of the result
+        """
+        if len(self.shape) != 3:
+            raise ValueError('Expression must evaluate to a cube, shape is {}'.format(self.shape))
+        if not self.cubes():
+            raise ValueError('Expression {} does not contain any cube'.format(self))
+
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        if out_variance is None and self.has_variance:
+            out_variance = np.empty(self.shape, dtype=self.dtype)
+
+        chunk_planes = chunk_planes or self._default_chunk_planes()
+        slices = [slice(start, min(start + chunk_planes, self.shape[0]))
+                  for start in range(0, self.shape[0], chunk_planes)]
+
+        def run(sl):
+            values, variance = self._chunk(sl)
+            out[sl] = values
+            if out_variance is not None:
+                out_variance[sl] = variance if variance is not None else 0
+
+        logger.debug('evaluating {} in {} chunks'.format(self, len(slices)))
+
+        # Keep the data of cubes with a memory budget loaded until done, otherwise
+        # each chunk could evict one operand to read another.
+        with pin_data(self.cubes()):
+            if threads:
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    # list() so exceptions from the workers are raised here
+                    list(executor.map(run, slices))
+            else:
+                for sl in slices:
+                    run(sl)
+
+        # The header of the first cube, without what describes its data rather than the result.
+        template = self.cubes()[0]
+        header = dict(template.other_header)
+        header.pop('EXTNAME', None)
+        try:
+            header['BUNIT'] = self.unit.to_string('fits')
+        except ValueError:
+            header.pop('BUNIT', None)
+
+        return template.__class__(template.name, out, self.unit, header,
+                                  template.wavelength, error=out_variance,
+                                  error_type='variance')
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CubeTerm(CubeExpression):
+    """Leaf of the expression that reads from an IFUCube."""
+
+    def __init__(self, cube):
+        self._cube = cube
+
+        # Hold on to the packed mask so chunks evaluated in threads do not
+        # go through (or get evicted from) the shared mask cache.
+        self._mask = cube.mask()
+
+    @property
+    def shape(self):
+        return self._cube.shape
+
+    @property
+    def unit(self):
+        return self._cube.unit
+
+    @property
+    def dtype(self):
+        # IFUCube.dtype is known without loading data held by a data cache.
+        return np.result_type(self._cube.dtype, np.float32)
+
+    @property
+    def has_variance(self):
+        return self._cube.error is not None
+
+    def cubes(self):
+        return [self._cube]
+
+    def _chunk(self, sl):
+        values = np.asarray(self._cube.data[sl], dtype=self.dtype)
+
+        variance = None
+        if self._cube.error is not None:
+            variance = error_to_variance(self._cube.error[sl], self._cube.error_type)
+
+        # Masked voxels are propagated as NaN, in the variance too so they
+        # cannot be mistaken for valid voxels downstream.
+        if self._mask is not None:
+            bad = self._mask.unpack_planes(sl)
+            values = np.where(bad, np.nan, values)
+            if variance is not None:
+                variance = np.where(bad, np.nan, variance)
+
+        return values, variance
+
+    def __str__(self):
+        return self._cube.name or 'cube'
+
+
+class ConstantTerm(CubeExpression):
+    """
+    Leaf of the expression for a scalar, Quantity or an array that
+    broadcasts against the cube (e.g. a continuum or sensitivity curve
+    with shape (n, 1, 1)).  Constants have no variance.
+    """
+
+    def __init__(self, value):
+        if isinstance(value, u.Quantity):
+            self._unit = value.unit
+            value = value.value
+        else:
+            self._unit = u.dimensionless_unscaled
+
+        self._value = np.asarray(value)
+
+    @property
+    def shape(self):
+        return self._value.shape
+
+    @property
+    def unit(self):
+        return self._unit
+
+    @property
+    def dtype(self):
+        # Scalars are weak, like Python scalars in numpy, so multiplying a
+        # float32 cube by 2 does not make the result float64.
+        if self._value.ndim == 0:
+            return np.result_type(np.min_scalar_type(self._value), np.float32)
+        return np.result_type(self._value.dtype, np.float32)
+
+    @property
+    def has_variance(self):
+        return False
+
+    def _chunk(self, sl):
+        if self._value.ndim == 0:
+            # A Python scalar so numpy treats it as weak when computing the chunk,
+            # unless it needs more than float32 (e.g. 1e300) and so must promote.
+            if self.dtype == np.float32:
+                return self._value.item(), None
+            return self._value.astype(self.dtype), None
+
+        # Only arrays with a full spectral axis are sliced, the rest broadcast as is.
+        if self._value.ndim == 3 and self._value.shape[0] > 1:
+            return self._value[sl], None
+        return self._value, None
+
+    def __str__(self):
+        return str(self._value) if self._value.ndim == 0 else 'array{}'.format(self._value.shape)
+
+
+class BinaryOp(CubeExpression):
+    """Arithmetic between two expressions."""
+
+    symbols = {
+        operator.add: '+',
+        operator.sub: '-',
+        operator.mul: '*',
+        operator.truediv: '/',
+    }
+
+    def __init__(self, op, left, right):
+        self._op = op
+        self._left = left
+        self._right = right
+
+        # Check up front that the shapes broadcast and the units are consistent.
+        self._shape = np.broadcast_shapes(left.shape, right.shape)
+
+        if op in (operator.add, operator.sub):
+            # Raises UnitConversionError if the units are not compatible
+            self._right_scale = right.unit.to(left.unit)
+            self._unit = left.unit
+        else:
+            self._right_scale = 1.0
+            self._unit = op(left.unit, right.unit)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def unit(self):
+        return self._unit
+
+    @property
+    def dtype(self):
+        return np.result_type(self._left.dtype, self._right.dtype)
+
+    @property
+    def has_variance(self):
+        return self._left.has_variance or self._right.has_variance
+
+    def cubes(self):
+        return self._left.cubes() + self._right.cubes()
+
+    def _chunk(self, sl):
+        a, var_a = self._left._chunk(sl)
+        b, var_b = self._right._chunk(sl)
+
+        if self._right_scale != 1.0:
+            b = b * self._right_scale
+            if var_b is not None:
+                var_b = var_b * self._right_scale**2
+
+        values = self._op(a, b)
+
+        if var_a is None and var_b is None:
+            return values, None
+
+        var_a = 0 if var_a is None else var_a
+        var_b = 0 if var_b is None else var_b
+
+        if self._op in (operator.add, operator.sub):
+            variance = var_a + var_b
+        elif self._op is operator.mul:
+            variance = b**2 * var_a + a**2 * var_b
+        else:
+            variance = var_a / b**2 + a**2 * var_b / b**4
+
+        return values, np.broadcast_to(variance, values.shape)
+
+    def __str__(self):
+        return '({} {} {})'.format(self._left, self.symbols[self._op], self._right)
+
+
+def as_expression(value):
+    """
+    Wrap the value as an expression leaf if it is not one already.
+
+    :param value: CubeExpression, IFUCube, scalar, Quantity or array
+    :return: CubeExpression
+    """
+    if isinstance(value, CubeExpression):
+        return value
+    if hasattr(value, 'lazy'):
+        return value.lazy()
+    return ConstantTerm(value)
@@ -0,0 +1,315 @@
+"""Registry of data configuration YAML files, parsed once and cached on disk"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import yaml
+
+from .arithmetic import ERROR_TYPES
+from .dq import DQPolicy
+
+__all__ = ['ConfigRegistry', 'validate_config', 'get_registry']
+
+logger = logging.getLogger('ifucube')
+
+DEFAULT_DATA_CONFIGS = os.path.join(os.path.dirname(__file__), 'configurations')
+CUBEVIZ_DATA_CONFIGS = 'CUBEVIZ_DATA_CONFIGS'
+
+# Environment variable to override where the compiled configurations are cached.
+IFUCUBE_CONFIG_CACHE = 'IFUCUBE_CONFIG_CACHE'
+DEFAULT_CONFIG_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'ifucube', 'configurations.json')
+
+# Bump when the compiled format changes so old caches are ignored.
+CACHE_VERSION = 2
+
+# Keys that can appear in a match block, see DataConfiguration._process
+MATCH_KEYS = ('all', 'any', 'equal', 'startswith', 'extension_names')
+
+
+def _validate_match(conditionals, path):
+    """
+    Check the match block recursively.
+
+    :param conditionals: Dictionary of conditionals
+    :param path: Where we are, for the error message
+    """
+    if not isinstance(conditionals, dict):
+        raise ValueError('{} must be a mapping, got {!r}'.format(path, conditionals))
+
+    for key, conditional in conditionals.items():
+        if key not in MATCH_KEYS:
+            raise ValueError('{}: unknown match key {!r}, expected one of {}'.format(path, key, MATCH_KEYS))
+
+        if key in ('all', 'any'):
+            _validate_match(conditional, '{}.{}'.format(path, key))
+        elif key in ('equal', 'startswith'):
+            if not isinstance(conditional, dict) or 'header_key' not in conditional or 'value' not in conditional:
+                raise ValueError('{}.{} needs header_key and value'.format(path, key))
+        elif not isinstance(conditional, (str, list)):
+            raise ValueError('{}.{} must be a name or list of names'.format(path, key))
+
+
+def validate_config(cfg, config_file=''):
+    """
+    Check a parsed data configuration and normalize it.
+
+    :param cfg: Dictionary parsed from the YAML file
+    :param config_file: Filename, for the error messages
+    :return: The normalized dictionary
+    """
+    if not isinstance(cfg, dict):
+        raise ValueError('{}: data configuration must be a mapping'.format(config_file))
+
+    for key in ('name', 'type', 'match'):
+        if key not in cfg:
+            raise ValueError('{}: data configuration is missing {!r}'.format(config_file, key))
+
+    if 'all' not in cfg['match']:
+        raise ValueError('{}: match block must start with "all"'.format(config_file))
+    _validate_match(cfg['match'], '{}: match'.format(config_file))
+
+    try:
+        cfg['priority'] = int(cfg.get('priority', 0))
+    except (TypeError, ValueError):
+        cfg['priority'] = 0
+
+    data = cfg.get('data', None)
+    if data is not None and not isinstance(data, dict):
+        raise ValueError('{}: data block must be a mapping'.format(config_file))
+
+    error_type = cfg.get('error_type', 'stddev')
+    if error_type not in ERROR_TYPES:
+        raise ValueError('{}: unknown error_type {!r}, expected one of {}'.format(config_file, error_type, ERROR_TYPES))
+
+    # Build the policy the same way DataConfiguration does so anything accepted here also loads.
+    try:
+        DQPolicy.constructFromConfig(cfg['name'], cfg.get('dq_policy', None))
+    except ValueError as e:
+        raise ValueError('{}: {}'.format(config_file, e))
+
+    if not isinstance(cfg.get('flux_unit_replacements', {}), dict):
+        raise ValueError('{}: flux_unit_replacements must be a mapping'.format(config_file))
+
+    return cfg
+
+
+def _survives_json(cfg):
+    """Whether the configuration reads back from the JSON cache unchanged."""
+    try:
+        return json.loads(json.dumps(cfg)) == cfg
+    except (TypeError, ValueError):
+        return False
+
+
+class ConfigRegistry:
+    """
+    Finds the data configuration YAML files and compiles (parses and
+    validates) each of them once.
+
+    Compiled configurations are kept in memory and in a JSON cache on disk.
+    A cached entry is reused while the file modification time and size are
+    unchanged, or, if they changed, while the content hash still matches.
+    Configurations JSON cannot hold as they are (e.g. with dates or
+    non-string keys) are only kept in memory.
+    """
+
+    def __init__(self, cache_file=None):
+        """
+        :param cache_file: JSON file to cache compiled configurations in, by default
+                           $IFUCUBE_CONFIG_CACHE or ~/.cache/ifucube/configurations.json.
+                           False disables the on-disk cache.
+        """
+        if cache_file is None:
+            cache_file = os.environ.get(IFUCUBE_CONFIG_CACHE, DEFAULT_CONFIG_CACHE)
+
+        self._cache_file = cache_file
+        self._entries = self._read_cache()
+        self._dirty = False
+
+        # Directory listings keyed on directory, with the mtime they were made at.
+        self._listings = {}
+
+        self.parsed = 0
+
+    #
+    # Finding files
+    #
+
+    def _list_directory(self, directory):
+        mtime = os.stat(directory).st_mtime_ns
+
+        listing = self._listings.get(directory, None)
+        if listing is None or listing[0] != mtime:
+            listing = (mtime, sorted(glob.glob(os.path.join(directory, '*.yaml'))))
+            self._listings[directory] = listing
+
+        return listing[1]
+
+    def find_yaml_files(self, files_or_directories):
+        """
+        Given the files_or_directories, create a list of all relevant YAML files.
+
+        :param files_or_directories: File, directory, colon separated string of them or a list of them
+        :return: list of filenames
+        """
+        config_files = []
+
+        # If the thing passed in was a string then we'll split on colon. If there is only one
+        # directory then it will create a list anyway.
+        if isinstance(files_or_directories, str):
+            files_or_directories = files_or_directories.split(':')
+
+        for x in files_or_directories:
+            if os.path.isfile(x):
+                config_files.append(x)
+            elif os.path.isdir(x):
+                config_files.extend(self._list_directory(x))
+
+        return config_files
+
+    def search_paths(self, in_configs=()):
+        """
+        Files and directories searched, in order: command line, environment
+        variable CUBEVIZ_DATA_CONFIGS and the default directory.
+
+        :param in_configs: Files or directories from the command line
+        :return: list
+        """
+        paths = in_configs.split(':') if isinstance(in_configs, str) else list(in_configs)
+
+        if CUBEVIZ_DATA_CONFIGS in os.environ:
+            paths.extend(os.environ[CUBEVIZ_DATA_CONFIGS].split(':'))
+
+        paths.append(DEFAULT_DATA_CONFIGS)
+
+        return paths
+
+    #
+    # Compiling
+    #
+
+    def _read_cache(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return {}
+
+        try:
+            with open(self._cache_file, 'r') as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable configuration cache {}: {}'.format(self._cache_file, e))
+            return {}
+
+        if cache.get('version', None) != CACHE_VERSION:
+            return {}
+
+        return cache.get('entries', {})
+
+    def save(self):
+        """Write the compiled configurations to the on-disk cache if anything changed."""
+        if not self._cache_file or not self._dirty:
+            return
+
+        entries = {path: entry for path, entry in self._entries.items() if entry.get('cache', True)}
+
+        # Write then rename so concurrent workers never read a partial file.
+        tmp_file = '{}.{}.tmp'.format(self._cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._cache_file) or '.', exist_ok=True)
+
+            with open(tmp_file, 'w') as fp:
+                json.dump({'version': CACHE_VERSION, 'entries': entries}, fp)
+            os.replace(tmp_file, self._cache_file)
+
+            self._dirty = False
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning('Could not write configuration cache {}: {}'.format(self._cache_file, e))
+            if os.path.exists(tmp_file):
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    def compile(self, config_file):
+        """
+        Return the parsed and validated configuration, from the cache when possible.
+
+        :param config_file: YAML filename
+        :return: dict with the configuration plus '_config_file' and '_sha256'
+        """
+        path = os.path.realpath(config_file)
+        stat = os.stat(path)
+
+        entry = self._entries.get(path, None)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry['config']
+
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        if entry is None or entry['config']['_sha256'] != sha256:
+            logger.debug('Parsing data configuration {}'.format(path))
+            cfg = validate_config(yaml.safe_load(content), path)
+            cfg['_config_file'] = path
+            cfg['_sha256'] = sha256
+            self.parsed += 1
+        else:
+            # Only touched, the content is the same.
+            cfg = entry['config']
+
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'config': cfg}
+        if not _survives_json(cfg):
+            logger.debug('Not caching data configuration {} on disk, JSON cannot hold it'.format(path))
+            entry['cache'] = False
+
+        self._entries[path] = entry
+        self._dirty = True
+
+        return cfg
+
+    def configurations(self, in_configs=()):
+        """
+        Compile every configuration found in the search paths.
+
+        Files reached through several search paths (or symbolic links),
+        and copies with identical content, only appear once: the first one
+        found wins.  Invalid configurations are logged and skipped.
+
+        :param in_configs: Files or directories from the command line
+        :return: list of compiled configuration dicts
+        """
+        configs = []
+        seen = set()
+
+        for config_file in self.find_yaml_files(self.search_paths(in_configs)):
+            try:
+                cfg = self.compile(config_file)
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                logger.error('Skipping data configuration {}: {}'.format(config_file, e))
+                continue
+
+            if cfg['_config_file'] in seen or cfg['_sha256'] in seen:
+                logger.debug('Skipping duplicate data configuration {}'.format(config_file))
+                continue
+
+            seen.update((cfg['_config_file'], cfg['_sha256']))
+            configs.append(cfg)
+
+        self.save()
+
+        return configs
+
+
+# Shared so every DataFactoryConfiguration in the process reuses the compiled configurations.
+registry = None
+
+
+def get_registry():
+    """Return the process wide ConfigRegistry, creating it on first use."""
+    global registry
+    if registry is None:
+        registry = ConfigRegistry()
+    return registry
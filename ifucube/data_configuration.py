@@ -1,8 +1,6 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from os.path import basename, splitext
-import yaml
 import os
-import glob
 import logging
 
 from glue.core import Data, Subset
@@ -13,14 +11,14 @@ from astropy.io import fits
 import numpy as np
 
 from ..listener import CUBEVIZ_LAYOUT
+from .config_registry import DEFAULT_DATA_CONFIGS, CUBEVIZ_DATA_CONFIGS, get_registry
+from .dq import DQPolicy
+from .ifucube import IFUCube
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('cubeviz_data_configuration')
 logger.setLevel(logging.INFO)
 
-DEFAULT_DATA_CONFIGS = os.path.join(os.path.dirname(__file__), 'configurations')
-CUBEVIZ_DATA_CONFIGS = 'CUBEVIZ_DATA_CONFIGS'
-
 
 class DataConfiguration:
     """
@@ -28,33 +26,34 @@ class DataConfiguration:
 
     """
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, cfg=None):
         """
         Given the configuration file, save it and grab the name and priority
         :param config_file:
+        :param cfg: Already compiled configuration (see ConfigRegistry), otherwise the file is parsed
         """
         self._config_file = config_file
 
-        with open(self._config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
+        if cfg is None:
+            cfg = get_registry().compile(config_file)
 
-            self._name = cfg['name']
-            self._type = cfg['type']
+        self._name = cfg['name']
+        self._type = cfg['type']
+        self._priority = cfg['priority']
 
+        self._configuration = cfg['match']
 
-            try:
-                self._priority = int(cfg.get('priority', 0))
-            except Exception:
-                self._priority = 0
+        self._data = cfg.get('data', None)
 
-            self._configuration = cfg['match']
+        self._dq_policy = DQPolicy.constructFromConfig(self._name, cfg.get('dq_policy', None))
 
-            self._data = cfg.get('data', None)
+        # How the ERROR extension stores the uncertainty: stddev, variance or ivar
+        self._error_type = cfg.get('error_type', 'stddev')
 
-            if 'flux_unit_replacements' in cfg:
-                self.flux_unit_replacements = cfg['flux_unit_replacements']
-            else:
-                self.flux_unit_replacements = {}
+        if 'flux_unit_replacements' in cfg:
+            self.flux_unit_replacements = cfg['flux_unit_replacements']
+        else:
+            self.flux_unit_replacements = {}
 
     @property
     def name(self):
@@ -64,6 +63,27 @@ class DataConfiguration:
     def type(self):
         return self._type
 
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def dq_policy(self):
+        return self._dq_policy
+
+    @property
+    def error_type(self):
+        return self._error_type
+
+    def _is_dq(self, extname):
+        """
+        True if the extension holds the DQ flags according to the data block.
+
+        :param extname:
+        :return:
+        """
+        return self._data is not None and str(self._data.get('DQ', None)) == extname
+
     def get_units(self, header):
         """
         Extract BUNIT from header.
@@ -132,8 +152,12 @@ class DataConfiguration:
                     if 'EXTNAME' in hdu.header:
                         component_name = hdu.header['EXTNAME']
 
-                        # The data must be floating point as spectralcube is expecting floating point data
-                        data.add_component(component=hdu.data.astype(np.float), label=component_name)
+                        # The DQ flags are bit fields so they are kept in their native integer dtype,
+                        # everything else must be floating point as spectralcube is expecting floating point data
+                        if self._is_dq(component_name) and np.issubdtype(hdu.data.dtype, np.integer):
+                            data.add_component(component=hdu.data, label=component_name)
+                        else:
+                            data.add_component(component=hdu.data.astype(np.float), label=component_name)
 
                         if 'BUNIT' in hdu.header:
                             c = data.get_component(component_name)
@@ -147,6 +171,31 @@ class DataConfiguration:
 
         return data
 
+    def load_ifucube(self, data_filename):
+        """
+        Load the FLUX extension defined in the matching YAML file as an IFUCube,
+        with the ERROR and DQ extensions attached so that cube arithmetic
+        propagates the uncertainty and masks bad voxels.
+
+        :param data_filename:
+        :return: IFUCube
+        """
+        hdulist = fits.open(data_filename)
+
+        def extension(key):
+            name = self._data.get(key, None) if self._data else None
+            if name is None or str(name) == 'None':
+                return None
+            # Numbered extensions (e.g. KMOS) are indices rather than names
+            return hdulist[name] if isinstance(name, int) or name in hdulist else None
+
+        flux_hdu = extension('FLUX')
+        if flux_hdu is None:
+            raise ValueError('{} has no FLUX extension as defined by {}'.format(data_filename, self._config_file))
+
+        return IFUCube.constructFromHDU(flux_hdu, error_hdu=extension('ERROR'), error_type=self._error_type,
+                                        dq_hdu=extension('DQ'), dq_policy=self._dq_policy)
+
     def matches(self, filename):
         """
         Main call to which we pass in the file to see if it matches based
@@ -329,25 +378,7 @@ class DataFactoryConfiguration:
         :param files_or_directories:
         :return:
         """
-        config_files = []
-
-        # If the thing passed in was a string then we'll split on colon. If there is only one
-        # directory then it will create a list anyway.
-        if isinstance(files_or_directories, str):
-            files_or_directories = files_or_directories.split(':')
-
-        for x in files_or_directories:
-            if os.path.exists(x):
-                # file, just append
-                if os.path.isfile(x):
-                    config_files.append(x)
-                # directory, find all yaml under it.
-                else:
-                    files  = glob.glob(os.path.join(x, '*.yaml'))
-                    config_files.extend(files)
-
-        return config_files
-
+        return get_registry().find_yaml_files(files_or_directories)
 
     def summarize(self):
         """
@@ -373,44 +404,30 @@ class DataFactoryConfiguration:
         if show_only:
             logger.setLevel(logging.DEBUG)
 
-        self._config_files = []
-
-        # Get all the available YAML data configuration files based on the command line.
-        logger.debug('YAML data configuration fiels from command line: {}'.format(in_configs))
-        self._config_files.extend(self._find_yaml_files(in_configs))
+        # The registry searches the command line, environment variable and default locations, in that
+        # order, and parses each YAML file only once (cached on disk between processes).
+        registry = get_registry()
+        logger.debug('YAML data configuration search paths: {}'.format(registry.search_paths(in_configs)))
 
-        # Get all the available YAML data configuration files based on the environment variable.
-        if CUBEVIZ_DATA_CONFIGS in os.environ:
-            logger.debug('YAML data configuration fiels from environment variable: {}'.format(os.environ[CUBEVIZ_DATA_CONFIGS]))
-            self._config_files.extend(self._find_yaml_files(os.environ[CUBEVIZ_DATA_CONFIGS]))
-
-        # Get all the available YAML data configuration files based on the default directory
-        logger.debug(
-            'YAML data configuration fiels from the default directory: {}'.format(DEFAULT_DATA_CONFIGS))
-        self._config_files.extend(self._find_yaml_files(DEFAULT_DATA_CONFIGS))
+        configs = registry.configurations(in_configs)
+        self._config_files = [cfg['_config_file'] for cfg in configs]
 
         logger.debug(
             'YAML data configuration files: {}'.format('\n'.join(self._config_files)))
 
-        for config_file in self._config_files:
-
-            # Load the YAML file and get the name, priority and create the data factory wrapper
-            with open(config_file, 'r') as yamlfile:
-                cfg = yaml.load(yamlfile)
-
-            name = cfg['name']
-
-            try:
-                priority = int(cfg.get('priority', 0))
-            except:
-                priority = 0
+        for cfg in configs:
 
             # The code below instantiates a data configuration object based on the config file and is
             # therefore dependent on the type of data file.  The data configuration object defines two functions
             # 'matches' and 'load_data' that are used.  We needed a way to call Glue's data_factory and be able
             # to pass in functions that have state information.
-            dc = DataConfiguration(config_file)
-            wrapper = data_factory(name, dc.matches, priority=priority)
+            try:
+                dc = DataConfiguration(cfg['_config_file'], cfg)
+            except ValueError as e:
+                logger.error('Skipping data configuration {}: {}'.format(cfg['_config_file'], e))
+                continue
+
+            wrapper = data_factory(dc.name, dc.matches, priority=dc.priority)
             wrapper(dc.load_data)
 
 
@@ -0,0 +1,280 @@
+"""Memory budget for cube data with least-recently-used eviction"""
+
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+
+__all__ = ['DataCache', 'pin_data']
+
+logger = logging.getLogger('ifucube')
+
+
+# Data type of each FITS BITPIX
+BITPIX_DTYPES = {8: np.uint8, 16: np.int16, 32: np.int32, 64: np.int64, -32: np.float32, -64: np.float64}
+
+
+def hdu_dtype(header):
+    """
+    Data type astropy gives the data of an HDU, worked out from the
+    header so the data does not have to be read.
+
+    :param header: HDU header
+    :return: numpy dtype
+    """
+    bitpix = header['BITPIX']
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+
+    if bitpix > 0 and (bscale != 1 or bzero != 0):
+        # Unsigned integers (and signed bytes) are stored with an offset.
+        if bscale == 1 and bitpix == 8 and bzero == -128:
+            return np.dtype(np.int8)
+        if bscale == 1 and bitpix > 8 and bzero == 2**(bitpix - 1):
+            return np.dtype('uint{}'.format(bitpix))
+
+        # Scaled integers, as astropy does
+        return np.dtype(np.float64 if bitpix > 16 else np.float32)
+
+    return np.dtype(BITPIX_DTYPES[bitpix])
+
+
+def hdu_loader(filename, index):
+    """
+    Function that reads the data of one extension of a FITS file.
+
+    :param filename:
+    :param index: Extension index
+    :return: function returning the data array
+    """
+    def load():
+        # memmap=False so the data is read into memory and the file can be closed.
+        with fits.open(filename, memmap=False) as hdulist:
+            return hdulist[index].data
+
+    return load
+
+
+class DataCache:
+    """
+    Keeps the data of IFUCubes in memory within a budget.
+
+    The data of a cube is loaded the first time it is accessed.  When the
+    loaded arrays exceed the budget, the least recently used ones are
+    dropped and will be loaded again on their next access.  Pinned data
+    (see pin_data) is never dropped.  Arrays that are still referenced
+    elsewhere are only freed once those references go away.
+    """
+
+    def __init__(self, memory_budget):
+        """
+        :param memory_budget: Maximum bytes of data to keep loaded, as an int or a Quantity (e.g. 4 * u.GB)
+        """
+        if isinstance(memory_budget, u.Quantity):
+            memory_budget = memory_budget.to_value(u.byte)
+
+        self._memory_budget = int(memory_budget)
+        if self._memory_budget <= 0:
+            raise ValueError('Memory budget must be positive, got {}'.format(memory_budget))
+
+        self._arrays = OrderedDict()
+        self._loaders = {}
+        self._nbytes = 0
+
+        # Pin counts of cubes whose data must not be evicted.
+        self._pins = {}
+
+        # Events of the cubes being read, keyed like _arrays.
+        self._loading = {}
+
+        # Cubes can be read from the threads of the lazy arithmetic.
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @property
+    def nbytes(self):
+        """Bytes of data currently loaded."""
+        return self._nbytes
+
+    def register(self, cube, loader):
+        """
+        Manage the data of the cube.
+
+        :param cube: IFUCube
+        :param loader: Function without arguments returning the data array
+        """
+        with self._lock:
+            self._loaders[id(cube)] = loader
+
+        # The id could be reused by a new object once the cube goes away.
+        weakref.finalize(cube, self._forget, id(cube))
+
+    def discard(self, cube):
+        """
+        Stop managing the data of the cube.
+
+        :param cube: IFUCube
+        """
+        self._forget(id(cube))
+
+    def _forget(self, key):
+        with self._lock:
+            self._loaders.pop(key, None)
+            self._pins.pop(key, None)
+            self._drop(key)
+
+    def pin(self, cube):
+        """
+        Do not evict the data of the cube until unpin() is called the same
+        number of times. Pinned data can take the cache over its budget.
+
+        :param cube: IFUCube
+        """
+        with self._lock:
+            self._pins[id(cube)] = self._pins.get(id(cube), 0) + 1
+
+    def unpin(self, cube):
+        """
+        Undo a pin(), evicting data if the cache is now over its budget.
+
+        :param cube: IFUCube
+        """
+        with self._lock:
+            key = id(cube)
+            if self._pins.get(key, 0) <= 1:
+                self._pins.pop(key, None)
+            else:
+                self._pins[key] -= 1
+
+            self._evict_to_budget()
+
+    def _evict_to_budget(self, keep=None):
+        """Evict least recently used unpinned data, except keep, until within budget."""
+        for key in list(self._arrays):
+            if self._nbytes <= self._memory_budget:
+                break
+            if key == keep or key in self._pins:
+                continue
+
+            self._drop(key)
+            self.evictions += 1
+
+    def get(self, cube):
+        """
+        Return the data of the cube, loading it if needed.
+
+        The file is read without holding the lock, so other threads can
+        use the cache meanwhile; threads asking for the same cube wait for
+        the one read.
+
+        :param cube: IFUCube
+        :return: The data array
+        """
+        key = id(cube)
+
+        while True:
+            with self._lock:
+                if key in self._arrays:
+                    self.hits += 1
+                    self._arrays.move_to_end(key)
+                    return self._arrays[key]
+
+                loading = self._loading.get(key, None)
+                if loading is None:
+                    loader = self._loaders[key]
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another thread is reading this cube, then look again.
+            loading.wait()
+
+        data = None
+        try:
+            data = loader()
+        finally:
+            with self._lock:
+                # Store before waking the waiting threads, so they find the data
+                # instead of reading it again. Only keep it if the cube was not
+                # discarded while reading.
+                if data is not None and key in self._loaders:
+                    self._drop(key)
+                    self._arrays[key] = data
+                    self._nbytes += data.nbytes
+
+                    # Never evict what was just loaded, even if it alone is over budget.
+                    self._evict_to_budget(keep=key)
+
+                # Also when the loader raised, so the waiting threads try themselves.
+                del self._loading[key]
+                loading.set()
+
+        return data
+
+    def is_loaded(self, cube):
+        return id(cube) in self._arrays
+
+    def _drop(self, key):
+        data = self._arrays.pop(key, None)
+        if data is not None:
+            self._nbytes -= data.nbytes
+            logger.debug('dropped {} bytes of cube data'.format(data.nbytes))
+
+    def clear(self):
+        """Drop all loaded data, keeping the statistics."""
+        with self._lock:
+            for key in list(self._arrays):
+                self._drop(key)
+
+    @property
+    def stats(self):
+        """Hits, misses, evictions and memory use so far."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'loaded': len(self._arrays),
+            'pinned': len(self._pins),
+            'nbytes': self._nbytes,
+            'memory_budget': self._memory_budget,
+        }
+
+    def __str__(self):
+        return 'DataCache {} of {} bytes loaded, {} hits {} misses {} evictions'.format(
+            self._nbytes, self._memory_budget, self.hits, self.misses, self.evictions)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+@contextmanager
+def pin_data(cubes):
+    """
+    Pin the data of the cubes that use a DataCache while in the context,
+    so code reading the cubes piece by piece (like the lazy arithmetic)
+    does not evict one operand to load the other.
+
+    :param cubes: IFUCubes, those without a data cache are ignored
+    """
+    pinned = []
+    try:
+        for cube in cubes:
+            if cube.data_cache is not None:
+                cube.data_cache.pin(cube)
+                pinned.append((cube.data_cache, cube))
+        yield
+    finally:
+        for data_cache, cube in pinned:
+            data_cache.unpin(cube)
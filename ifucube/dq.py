@@ -0,0 +1,360 @@
+"""Data quality (DQ) flags, bit policies and bit-packed bad pixel masks"""
+
+import logging
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['DQPolicy', 'DQFlags', 'PackedMask', 'DQMaskCache']
+
+logger = logging.getLogger('ifucube')
+
+
+class DQPolicy:
+    """
+    Describes which DQ bits mark a voxel as bad.
+
+    The policy is immutable and hashable so it can be used as part of the
+    key for the derived mask cache.  A policy with no ``bad_bits`` treats
+    any non-zero flag value as bad.
+    """
+
+    def __init__(self, name='default', bad_bits=None):
+        """
+        :param name: Name of the policy, typically the instrument config name
+        :param bad_bits: Iterable of bit positions (0 is the least significant bit)
+        """
+        self._name = name
+
+        if bad_bits is None:
+            self._bad_bits = None
+        else:
+            if isinstance(bad_bits, (str, bytes)) or not hasattr(bad_bits, '__iter__'):
+                raise ValueError('DQ bad bits must be a list of bit numbers, got {!r}'.format(bad_bits))
+
+            bad_bits = list(bad_bits)
+            if any(isinstance(b, bool) or not isinstance(b, (int, np.integer)) or b < 0 or b > 63
+                   for b in bad_bits):
+                raise ValueError('DQ bits must be integers between 0 and 63, got {}'.format(bad_bits))
+
+            self._bad_bits = tuple(sorted(set(int(b) for b in bad_bits)))
+
+    @classmethod
+    def constructFromConfig(cls, name, cfg):
+        """
+        Create a DQPolicy from the ``dq_policy`` block of a data configuration,
+        which looks like::
+
+            dq_policy:
+                bad_bits:
+                    - 0
+
+        :param name: Name of the data configuration
+        :param cfg: The ``dq_policy`` block, or None for the default policy
+        :return: DQPolicy
+        """
+        if not cfg:
+            return cls(name)
+
+        if not isinstance(cfg, dict):
+            raise ValueError('dq_policy must be a mapping with bad_bits, got {!r}'.format(cfg))
+
+        return cls(name, cfg.get('bad_bits', None))
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def bad_bits(self):
+        return self._bad_bits
+
+    @property
+    def bitmask(self):
+        """Integer with every bad bit set, or None if any non-zero value is bad."""
+        if self._bad_bits is None:
+            return None
+        return sum(1 << b for b in self._bad_bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, DQPolicy):
+            return NotImplemented
+        return (self._name, self._bad_bits) == (other._name, other._bad_bits)
+
+    def __hash__(self):
+        return hash((self._name, self._bad_bits))
+
+    def __str__(self):
+        return 'DQPolicy {} bad bits {}'.format(self._name,
+                                                self._bad_bits if self._bad_bits is not None else 'any')
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PackedMask:
+    """
+    Boolean mask stored with 1 bit per voxel.
+
+    True means the voxel is bad.
+    """
+
+    def __init__(self, mask):
+        """
+        :param mask: Boolean array (anything numpy can convert)
+        """
+        mask = np.asarray(mask, dtype=bool)
+
+        self._shape = mask.shape
+        self._packed = np.packbits(mask, axis=None)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def size(self):
+        return int(np.prod(self._shape))
+
+    @property
+    def nbytes(self):
+        return self._packed.nbytes
+
+    def unpack(self):
+        """
+        Expand back to a full boolean array.
+
+        :return: Boolean array of the original shape
+        """
+        return np.unpackbits(self._packed, count=self.size).view(bool).reshape(self._shape)
+
+    def unpack_planes(self, sl):
+        """
+        Expand only the planes of the first axis in the slice, without
+        unpacking the rest of the mask.
+
+        :param sl: Slice with a step of 1 along the first axis
+        :return: Boolean array of shape (planes,) + shape[1:]
+        """
+        start, stop, step = sl.indices(self._shape[0])
+        if step != 1:
+            raise ValueError('Only contiguous slices can be unpacked')
+
+        plane_size = int(np.prod(self._shape[1:]))
+        first, last = start * plane_size, max(start, stop) * plane_size
+
+        bits = np.unpackbits(self._packed[first // 8:(last + 7) // 8])
+        offset = first % 8
+
+        return bits[offset:offset + last - first].view(bool).reshape((max(0, stop - start),) + self._shape[1:])
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.unpack()
+        return mask if dtype is None else mask.astype(dtype)
+
+    def count(self):
+        """Number of bad voxels."""
+        # The padding bits at the end are always zero so can be counted too.
+        return int(np.unpackbits(self._packed).sum())
+
+    def apply(self, data, fill_value=np.nan):
+        """
+        Return a copy of the data with bad voxels replaced by fill_value.
+
+        :param data: Array with the same shape as the mask
+        :param fill_value: Value put into the bad voxels
+        :return: Array of floating point data
+        """
+        data = np.asarray(data)
+        if data.shape != self._shape:
+            raise ValueError('Data shape {} does not match mask shape {}'.format(data.shape, self._shape))
+
+        out = data.astype(np.result_type(data.dtype, np.float32), copy=True)
+        out[self.unpack()] = fill_value
+        return out
+
+    def masked(self, data):
+        """
+        Wrap the data in a numpy masked array using this mask.
+
+        :param data: Array with the same shape as the mask
+        :return: np.ma.MaskedArray
+        """
+        return np.ma.MaskedArray(data, mask=self.unpack())
+
+    def __str__(self):
+        return 'PackedMask {} with {} bytes'.format(self._shape, self.nbytes)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class DQMaskCache:
+    """
+    Least-recently-used cache of derived masks keyed on (DQFlags, DQPolicy).
+
+    Entries are dropped when the number of entries or the total packed size
+    exceeds the limits, and when the DQFlags they came from is garbage
+    collected.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=256 * 1024**2):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._masks = OrderedDict()
+        self._nbytes = 0
+        self._watched = set()
+
+    def get(self, flags, policy):
+        """
+        Return the mask for the flags under the policy, computing it if needed.
+
+        :param flags: DQFlags
+        :param policy: DQPolicy
+        :return: PackedMask
+        """
+        key = (id(flags), policy)
+
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        mask = PackedMask(flags.bad(policy))
+        self._masks[key] = mask
+        self._nbytes += mask.nbytes
+
+        # Forget every mask of this flags object once it goes away, as the
+        # id could be reused by a new object.
+        if key[0] not in self._watched:
+            self._watched.add(key[0])
+            weakref.finalize(flags, self._forget, key[0])
+
+        self._evict_to_limits()
+
+        return mask
+
+    def evict(self, flags_id=None):
+        """
+        Remove cached masks.
+
+        :param flags_id: Only remove masks of the DQFlags with this id, or everything if None.
+        """
+        for key in list(self._masks):
+            if flags_id is None or key[0] == flags_id:
+                self._nbytes -= self._masks.pop(key).nbytes
+
+    def _forget(self, flags_id):
+        self._watched.discard(flags_id)
+        self.evict(flags_id)
+
+    def _evict_to_limits(self):
+        while self._masks and (len(self._masks) > self._max_entries or self._nbytes > self._max_bytes):
+            key, mask = self._masks.popitem(last=False)
+            self._nbytes -= mask.nbytes
+            logger.debug('evicted DQ mask {}'.format(key))
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._masks)
+
+
+# Shared by all DQFlags so the limits apply across every loaded cube.
+mask_cache = DQMaskCache()
+
+
+class DQFlags:
+    """DQ flag values of one cube, kept in their native integer dtype."""
+
+    @classmethod
+    def constructFromHDU(cls, hdu, policy=None):
+        """
+        Create the DQFlags from a DQ HDU.
+
+        :param hdu: HDU with integer DQ data
+        :param policy: Default DQPolicy used by mask()
+        :return: DQFlags
+        """
+        return cls(hdu.data, policy=policy, name=hdu.header.get('EXTNAME', ''))
+
+    def __init__(self, flags, policy=None, name=''):
+        """
+        :param flags: Integer array of flag values
+        :param policy: Default DQPolicy used by mask()
+        :param name: Name of the extension the flags came from
+        """
+        flags = np.asarray(flags)
+
+        if not np.issubdtype(flags.dtype, np.integer) and not np.issubdtype(flags.dtype, np.bool_):
+            raise TypeError('DQ flags must be integer, got {}'.format(flags.dtype))
+
+        # FITS stores integers big endian, do the byte swap once here rather
+        # than on each mask derivation. Either way we keep our own copy.
+        if not flags.dtype.isnative:
+            flags = flags.astype(flags.dtype.newbyteorder('='))
+        else:
+            flags = flags.copy()
+
+        # Derived masks are cached per DQFlags, so the flags must not change
+        # underneath them. Create a new DQFlags to use different flags.
+        flags.flags.writeable = False
+
+        self._flags = flags
+        self.policy = policy if policy is not None else DQPolicy()
+        self._name = name
+
+    @property
+    def flags(self):
+        """The flag values, read-only so cached masks stay valid."""
+        return self._flags
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def shape(self):
+        return self._flags.shape
+
+    @property
+    def dtype(self):
+        return self._flags.dtype
+
+    def bad(self, policy=None):
+        """
+        Compute the unpacked boolean bad pixel mask, without caching.
+
+        :param policy: DQPolicy, or None to use the default policy of these flags
+        :return: Boolean array
+        """
+        policy = policy if policy is not None else self.policy
+        bitmask = policy.bitmask
+
+        if bitmask is None:
+            return self._flags != 0
+
+        if self._flags.dtype == np.bool_:
+            return self._flags if bitmask & 1 else np.zeros(self.shape, dtype=bool)
+
+        # Bits that do not fit in the dtype can never be set.
+        bitmask &= (1 << (8 * self._flags.dtype.itemsize)) - 1
+        return (self._flags & np.array(bitmask, dtype=np.uint64).astype(self._flags.dtype)) != 0
+
+    def mask(self, policy=None):
+        """
+        Bit-packed bad pixel mask, cached per (flags, policy).
+
+        :param policy: DQPolicy, or None to use the default policy of these flags
+        :return: PackedMask
+        """
+        policy = policy if policy is not None else self.policy
+        return mask_cache.get(self, policy)
+
+    def __str__(self):
+        return 'DQFlags {} {} {}'.format(self._name, self._flags.shape, self._flags.dtype)
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,490 @@
+"""Spatial index of cube footprints for cone and box searches"""
+
+import json
+import logging
+import math
+import warnings
+from collections import namedtuple
+
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+__all__ = ['Footprint', 'FootprintIndex', 'FootprintMatch']
+
+logger = logging.getLogger('ifucube')
+
+# Bump when the saved format changes.
+INDEX_VERSION = 1
+
+# Result of a query: the key of the cube and an (N, 2) array of (y, x)
+# spaxel indices, so cube.data[:, y, x] are the matching spectra.
+FootprintMatch = namedtuple('FootprintMatch', ['key', 'spaxels'])
+
+
+def _degrees(value):
+    """Accept floats in degrees or angular Quantities."""
+    if isinstance(value, u.Quantity):
+        return value.to_value(u.deg)
+    return float(value)
+
+
+def _unit_vector(ra, dec):
+    """
+    Unit vectors on the sphere for ra and dec in degrees.
+
+    :return: array of shape (..., 3)
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees (haversine, fine at small separations)."""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2)**2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2)**2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+class Footprint:
+    """
+    The sky area covered by the spaxels of one cube, described by its
+    celestial WCS and spatial shape, and bounded by a spherical cap used
+    for the fast rejection of candidates.
+    """
+
+    @classmethod
+    def constructFromCube(cls, key, cube):
+        """
+        :param key: Key returned by queries, e.g. filename and extension
+        :param cube: IFUCube with a celestial WCS and data of shape (nwave, ny, nx)
+        :return: Footprint
+        """
+        return cls(key, cube.celestial_wcs, cube.shape[1:])
+
+    def __init__(self, key, wcs, shape, center=None, radius=None):
+        """
+        :param key: Key returned by queries
+        :param wcs: 2D celestial WCS
+        :param shape: Spatial shape (ny, nx)
+        :param center: (ra, dec) of the bounding cap in degrees, computed if None
+        :param radius: Radius of the bounding cap in degrees, computed if None
+        """
+        if wcs.naxis != 2 or not wcs.has_celestial:
+            raise ValueError('Footprint of {} needs a 2D celestial WCS'.format(key))
+
+        self._key = key
+        self._wcs = wcs
+        self._shape = tuple(int(x) for x in shape)
+
+        # Size of a spaxel in degrees, used to size search windows.
+        self._pixel_scale = float(np.min(proj_plane_pixel_scales(wcs)))
+
+        if center is None or radius is None:
+            center, radius = self._bounding_cap()
+
+        self._center = (float(center[0]), float(center[1]))
+        self._radius = float(radius)
+        self._vector = _unit_vector(*self._center)
+
+    def _bounding_cap(self):
+        """
+        Cap enclosing the outer edges of the spaxels, from points along the
+        border of the spaxel grid.
+
+        :return: ((ra, dec), radius)
+        """
+        ny, nx = self._shape
+        xs = np.linspace(-0.5, nx - 0.5, max(2, nx + 1))
+        ys = np.linspace(-0.5, ny - 0.5, max(2, ny + 1))
+
+        x = np.concatenate([xs, xs, np.full(ys.size, -0.5), np.full(ys.size, nx - 0.5)])
+        y = np.concatenate([np.full(xs.size, -0.5), np.full(xs.size, ny - 0.5), ys, ys])
+
+        ra, dec = self._wcs.wcs_pix2world(x, y, 0)
+        vectors = _unit_vector(ra, dec)
+
+        center = vectors.mean(axis=0)
+        center /= np.linalg.norm(center)
+
+        radius = np.degrees(np.arccos(np.clip(vectors.dot(center), -1, 1))).max()
+
+        ra_c = math.degrees(math.atan2(center[1], center[0])) % 360
+        dec_c = math.degrees(math.asin(center[2]))
+
+        return (ra_c, dec_c), radius
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def wcs(self):
+        return self._wcs
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def center(self):
+        return self._center
+
+    @property
+    def radius(self):
+        return self._radius
+
+    @property
+    def vector(self):
+        return self._vector
+
+    def spaxels_in_cone(self, ra, dec, radius, predicate=None):
+        """
+        Spaxels whose centre is within the cone, plus the spaxel that
+        contains the centre of the cone.
+
+        :param ra: Right ascension in degrees
+        :param dec: Declination in degrees
+        :param radius: Radius in degrees
+        :param predicate: Optional function (ra, dec) -> bool array to further select spaxels
+        :return: (N, 2) int array of (y, x)
+        """
+        ny, nx = self._shape
+        x0, y0 = self._wcs.wcs_world2pix([[ra, dec]], 0)[0]
+        on_grid = -0.5 <= x0 < nx - 0.5 and -0.5 <= y0 < ny - 0.5
+
+        # The cone contains the whole footprint.
+        everything = _separation(ra, dec, *self._center) + self._radius <= radius
+
+        if on_grid and not everything:
+            # Only look at the window of spaxels that could be in the cone.
+            half = radius / self._pixel_scale + 1
+            x_lo, x_hi = max(0, int(math.floor(x0 - half))), min(nx - 1, int(math.ceil(x0 + half)))
+            y_lo, y_hi = max(0, int(math.floor(y0 - half))), min(ny - 1, int(math.ceil(y0 + half)))
+        else:
+            # Away from the grid the projection stretches distances (and is
+            # undefined beyond 90 degrees), so a window could miss spaxels.
+            x_lo, x_hi, y_lo, y_hi = 0, nx - 1, 0, ny - 1
+
+        y, x = np.mgrid[y_lo:y_hi + 1, x_lo:x_hi + 1]
+        y, x = y.ravel(), x.ravel()
+
+        s_ra, s_dec = self._wcs.wcs_pix2world(x, y, 0)
+        if everything:
+            selected = np.ones(x.shape, dtype=bool)
+        else:
+            selected = _separation(ra, dec, s_ra, s_dec) <= radius
+
+        # The spaxel containing the position covers it even if its centre is further away.
+        if on_grid:
+            selected |= (x == int(math.floor(x0 + 0.5))) & (y == int(math.floor(y0 + 0.5)))
+
+        if predicate is not None:
+            selected &= predicate(s_ra, s_dec)
+
+        return np.stack([y[selected], x[selected]], axis=-1)
+
+    def to_dict(self):
+        return {
+            'key': self._key,
+            'shape': list(self._shape),
+            'center': list(self._center),
+            'radius': self._radius,
+            'wcs': self._wcs.to_header_string(relax=True),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', fits.verify.VerifyWarning)
+            wcs = WCS(fits.Header.fromstring(d['wcs']))
+        # JSON turns tuple keys (e.g. filename and extension) into lists
+        key = tuple(d['key']) if isinstance(d['key'], list) else d['key']
+        return cls(key, wcs, d['shape'], d['center'], d['radius'])
+
+    def __str__(self):
+        return 'Footprint {} {} at ({:.6f}, {:.6f}) radius {:.6f} deg'.format(
+            self._key, self._shape, self._center[0], self._center[1], self._radius)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class FootprintIndex:
+    """
+    Index of cube footprints for cone and box searches.
+
+    The sky is split into declination bands of cell_size degrees, and each
+    band into right ascension cells of roughly the same area.  A footprint
+    is registered in every cell its bounding cap overlaps, so a query only
+    looks at the footprints in the cells the query overlaps, then checks
+    the bounding caps and finally the individual spaxels.
+    """
+
+    def __init__(self, cell_size=0.5):
+        """
+        :param cell_size: Size of the cells in degrees, a few times the typical footprint is good
+        """
+        self._cell_size = float(cell_size)
+        self._nbands = int(math.ceil(180.0 / self._cell_size))
+
+        self._footprints = {}
+        self._cells = {}
+
+    #
+    # Cells
+    #
+
+    def _band(self, dec):
+        return min(self._nbands - 1, max(0, int((dec + 90.0) // self._cell_size)))
+
+    def _ncells(self, band):
+        # Number of ra cells in the band, fewer towards the poles.
+        dec_lo = -90.0 + band * self._cell_size
+        dec_hi = min(90.0, dec_lo + self._cell_size)
+        cos_dec = max(math.cos(math.radians(dec_lo)), math.cos(math.radians(dec_hi)))
+        return max(1, int(math.ceil(360.0 * cos_dec / self._cell_size)))
+
+    def _cells_in_range(self, ra_lo, ra_hi, dec_lo, dec_hi):
+        """
+        Cells overlapping the ra/dec range. ra_lo > ra_hi means the range
+        wraps through ra = 0, ra_lo is None for all ra.
+        """
+        for band in range(self._band(dec_lo), self._band(dec_hi) + 1):
+            ncells = self._ncells(band)
+            width = 360.0 / ncells
+
+            if ra_lo is None:
+                cells = range(ncells)
+            else:
+                first, last = int(ra_lo // width) % ncells, int(ra_hi // width) % ncells
+                if first <= last and ra_lo <= ra_hi:
+                    cells = range(first, last + 1)
+                else:
+                    cells = list(range(first, ncells)) + list(range(0, last + 1))
+
+            for cell in cells:
+                yield band, cell
+
+    def _cells_for_cap(self, ra, dec, radius):
+        dec_lo, dec_hi = dec - radius, dec + radius
+
+        # The cap contains a pole, or is too wide to bound in ra.
+        if dec_lo <= -90.0 or dec_hi >= 90.0:
+            return self._cells_in_range(None, None, max(dec_lo, -90.0), min(dec_hi, 90.0))
+
+        ratio = math.sin(math.radians(radius)) / math.cos(math.radians(dec))
+        if ratio >= 1.0:
+            return self._cells_in_range(None, None, dec_lo, dec_hi)
+
+        half_width = math.degrees(math.asin(ratio))
+
+        return self._cells_in_range((ra - half_width) % 360, (ra + half_width) % 360, dec_lo, dec_hi)
+
+    #
+    # Updating
+    #
+
+    def add(self, footprint):
+        """
+        Add (or replace) a footprint.
+
+        :param footprint: Footprint
+        """
+        if footprint.key in self._footprints:
+            self.remove(footprint.key)
+
+        self._footprints[footprint.key] = footprint
+        for cell in self._cells_for_cap(footprint.center[0], footprint.center[1], footprint.radius):
+            self._cells.setdefault(cell, set()).add(footprint.key)
+
+    def add_cube(self, key, cube):
+        """
+        Add the footprint of a cube.
+
+        :param key: Key returned by queries, e.g. filename and extension
+        :param cube: IFUCube
+        """
+        self.add(Footprint.constructFromCube(key, cube))
+
+    def remove(self, key):
+        """
+        Remove the footprint with the key.
+
+        :param key:
+        """
+        footprint = self._footprints.pop(key)
+        for cell in self._cells_for_cap(footprint.center[0], footprint.center[1], footprint.radius):
+            keys = self._cells.get(cell, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._cells[cell]
+
+    @classmethod
+    def constructFromIFUList(cls, ifulist, keys=None, cell_size=0.5):
+        """
+        Index every cube of an IFUList.
+
+        :param ifulist: IFUList
+        :param keys: Keys for the cubes, by default their position in the list
+        :param cell_size: See FootprintIndex
+        :return: FootprintIndex
+        """
+        index = cls(cell_size)
+        keys = keys if keys is not None else range(len(ifulist))
+        for key, cube in zip(keys, ifulist):
+            index.add_cube(key, cube)
+        return index
+
+    #
+    # Queries
+    #
+
+    def _candidates(self, ra, dec, radius):
+        keys = set()
+        for cell in self._cells_for_cap(ra, dec, radius):
+            keys.update(self._cells.get(cell, ()))
+
+        if not keys:
+            return []
+
+        # Reject the footprints whose bounding cap does not reach the query cap.
+        footprints = [self._footprints[key] for key in keys]
+        vectors = np.array([f.vector for f in footprints])
+        radii = np.array([f.radius for f in footprints])
+
+        distance = np.degrees(np.arccos(np.clip(vectors.dot(_unit_vector(ra, dec)), -1, 1)))
+
+        return [f for f, keep in zip(footprints, distance <= radii + radius) if keep]
+
+    def query_cone(self, ra, dec, radius=0.0):
+        """
+        Cubes and spaxels in a cone. With radius 0 this gives the spaxels
+        covering the position.
+
+        :param ra: Right ascension in degrees or as a Quantity
+        :param dec: Declination in degrees or as a Quantity
+        :param radius: Radius in degrees or as a Quantity
+        :return: list of FootprintMatch
+        """
+        ra, dec, radius = _degrees(ra) % 360, _degrees(dec), _degrees(radius)
+
+        matches = []
+        for footprint in self._candidates(ra, dec, radius):
+            spaxels = footprint.spaxels_in_cone(ra, dec, radius)
+            if len(spaxels):
+                matches.append(FootprintMatch(footprint.key, spaxels))
+
+        return matches
+
+    def query_box(self, ra_min, ra_max, dec_min, dec_max):
+        """
+        Cubes and spaxels whose centre lies in an ra/dec box. The box
+        wraps through ra = 0 when ra_min > ra_max, and covers all ra when
+        ra_max - ra_min >= 360.
+
+        :param ra_min: Right ascension in degrees or as a Quantity
+        :param ra_max:
+        :param dec_min: Declination in degrees or as a Quantity
+        :param dec_max:
+        :return: list of FootprintMatch
+        """
+        ra_min, ra_max = _degrees(ra_min), _degrees(ra_max)
+        dec_min, dec_max = max(_degrees(dec_min), -90.0), min(_degrees(dec_max), 90.0)
+
+        # Keep the width, only normalize where the box starts.
+        all_ra = ra_max - ra_min >= 360
+        ra_width = 360.0 if all_ra else (ra_max - ra_min) % 360
+        ra_min = ra_min % 360
+
+        def in_box(s_ra, s_dec):
+            in_ra = True if all_ra else (s_ra - ra_min) % 360 <= ra_width
+            return in_ra & (s_dec >= dec_min) & (s_dec <= dec_max)
+
+        # Small boxes: only the spaxels in the cap around the box are checked.
+        cap = None
+        if ra_width <= 180:
+            ra_c = (ra_min + ra_width / 2) % 360
+            dec_c = (dec_min + dec_max) / 2
+            corners = np.array([[ra_min, dec_min], [ra_min, dec_max], [ra_min + ra_width, dec_min],
+                                [ra_min + ra_width, dec_max], [ra_c, dec_min], [ra_c, dec_max]])
+            cap = (ra_c, dec_c, _separation(ra_c, dec_c, corners[:, 0], corners[:, 1]).max())
+
+        # Every footprint is registered in all the cells its cap overlaps, so
+        # the cells of the box hold every footprint that could overlap it.
+        keys = set()
+        for cell in self._cells_in_range(None if all_ra else ra_min, (ra_min + ra_width) % 360,
+                                         dec_min, dec_max):
+            keys.update(self._cells.get(cell, ()))
+
+        matches = []
+        for key in keys:
+            footprint = self._footprints[key]
+
+            if cap is not None and cap[2] < footprint.radius:
+                spaxels = footprint.spaxels_in_cone(*cap, predicate=in_box)
+            else:
+                # The box is bigger than the footprint, check all of its spaxels.
+                spaxels = footprint.spaxels_in_cone(footprint.center[0], footprint.center[1],
+                                                    footprint.radius, predicate=in_box)
+
+            if len(spaxels):
+                matches.append(FootprintMatch(footprint.key, spaxels))
+
+        return matches
+
+    #
+    # Persistence
+    #
+
+    def save(self, filename):
+        """
+        Write the index as JSON, e.g. next to the cube files.
+
+        :param filename:
+        """
+        with open(filename, 'w') as fp:
+            json.dump({
+                'version': INDEX_VERSION,
+                'cell_size': self._cell_size,
+                'footprints': [f.to_dict() for f in self._footprints.values()],
+            }, fp)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read an index written by save().
+
+        :param filename:
+        :return: FootprintIndex
+        """
+        with open(filename, 'r') as fp:
+            saved = json.load(fp)
+
+        if saved.get('version', None) != INDEX_VERSION:
+            raise ValueError('{} is not a version {} footprint index'.format(filename, INDEX_VERSION))
+
+        index = cls(saved['cell_size'])
+        for d in saved['footprints']:
+            index.add(Footprint.from_dict(d))
+
+        return index
+
+    def __contains__(self, key):
+        return key in self._footprints
+
+    def __getitem__(self, key):
+        return self._footprints[key]
+
+    def __len__(self):
+        return len(self._footprints)
+
+    def __str__(self):
+        return 'FootprintIndex with {} footprints in {} cells'.format(len(self._footprints), len(self._cells))
+
+    def __repr__(self):
+        return self.__str__()
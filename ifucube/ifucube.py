@@ -1,10 +1,17 @@
 """IFUCube is one instance of a 3D IFU dataset"""
 
 import logging
+import warnings
 
+import numpy as np
 from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
 from traitlets import HasTraits, Unicode, Instance, Dict
 
+from .arithmetic import CubeTerm, ERROR_TYPES, as_expression, error_to_variance
+from .datacache import hdu_dtype
+from .dq import DQFlags
 from .wavelength import Wavelength, WavelengthLinearModel
 
 logger = logging.getLogger('ifucube')
@@ -29,14 +36,24 @@ class IFUCube(HasTraits):
     _wavelength = Instance(Wavelength)
     _other_header = Dict()
 
+    # Make numpy arrays and Quantities defer to our reflected operators.
+    __array_ufunc__ = None
+
     @classmethod
-    def constructFromHDU(cls, hdu, wavelength=None):
+    def constructFromHDU(cls, hdu, wavelength=None, error_hdu=None, error_type='stddev',
+                         dq_hdu=None, dq_policy=None, data_cache=None, data_loader=None):
         """
         Create an IFUCube from the HDU read in. It should have a
         reasonably normal header and 3D data otherwise will error.
 
         :param hdu:
         :param wavelength:
+        :param error_hdu: Optional HDU with the uncertainty (ERR, STAT, IVAR...)
+        :param error_type: How error_hdu stores the uncertainty: 'stddev', 'variance' or 'ivar'
+        :param dq_hdu: Optional HDU with the DQ flags
+        :param dq_policy: DQPolicy used to derive the bad pixel mask from dq_hdu
+        :param data_cache: Optional DataCache, the data is then only read (by data_loader) when accessed
+        :param data_loader: Function returning the data of the HDU, required with data_cache
         :return:
         """
 
@@ -44,11 +61,21 @@ class IFUCube(HasTraits):
             wavelength = Wavelength.constructFromHDU(hdu)
 
         name = hdu.header.get('EXTNAME', '')
-        data = hdu.data  # should check that it exists
+        # With a data cache only the header is read here.
+        data = hdu.data if data_cache is None else None  # should check that it exists
         unit = hdu.header.get('BUNIT', '') # auto convert to u.dimensionless
         other_header = dict(hdu.header)
+        error = error_hdu.data if error_hdu is not None else None
+        dq = DQFlags.constructFromHDU(dq_hdu, dq_policy) if dq_hdu is not None else None
 
-        return cls(name, data, unit, other_header, wavelength)
+        cube = cls(name, data, unit, other_header, wavelength,
+                   dq=dq, error=error, error_type=error_type)
+
+        if data_cache is not None:
+            shape = tuple(hdu.header['NAXIS{}'.format(i)] for i in range(hdu.header['NAXIS'], 0, -1))
+            cube.use_data_cache(data_cache, data_loader, shape, hdu_dtype(hdu.header))
+
+        return cube
 
     @classmethod
     def constructFromASDF(cls, tree, wavelength_tree=None):
@@ -62,18 +89,26 @@ class IFUCube(HasTraits):
         return cls(name, data, unit, other_header, wavelength)
 
 
-    def __init__(self, name=None, data=None, unit=None, other_header=None, wavelength=None):
+    def __init__(self, name=None, data=None, unit=None, other_header=None, wavelength=None, dq=None,
+                 error=None, error_type='stddev'):
         super().__init__()
 
+        self._data_cache = None
+        self._shape = None
+        self._dtype = None
+
         self.name = name if name else ''
         self.unit = unit
         self.data = data
         self.other_header = other_header
         self.wavelength = wavelength
+        self.dq = dq
+        self.error_type = error_type
+        self.error = error
 
     def __str__(self):
         return 'IFUCube {} with data {} {}'.format(self.name,
-                                                   self.data.shape if hasattr(self.data, 'shape') else 'Empty',
+                                                   self.shape if self.shape is not None else 'Empty',
                                                    self.unit)
     def __repr__(self):
         return self.__str__()
@@ -85,6 +120,10 @@ class IFUCube(HasTraits):
     @unit.setter
     def unit(self, value):
 
+        if isinstance(value, u.UnitBase):
+            self._unit = value
+            return
+
         # If this is a string coming in, then let's first
         # fix any issues based on the mapping.
         for m in IFUCube.unit_mapping:
@@ -115,11 +154,50 @@ class IFUCube(HasTraits):
 
     @property
     def data(self):
+        if self._data_cache is not None:
+            return self._data_cache.get(self)
         return self._data
 
     @data.setter
     def data(self, value):
+        # Explicitly set data is no longer managed by the data cache.
+        if self._data_cache is not None:
+            self._data_cache.discard(self)
+            self._data_cache = None
+
         self._data = value
+        self._shape = value.shape if hasattr(value, 'shape') else None
+        self._dtype = value.dtype if hasattr(value, 'dtype') else None
+
+    @property
+    def shape(self):
+        """Shape of the data, known without loading it when a data cache is used."""
+        return self._shape
+
+    @property
+    def dtype(self):
+        """Data type of the data, known without loading it when a data cache is used."""
+        return self._dtype
+
+    @property
+    def data_cache(self):
+        return self._data_cache
+
+    def use_data_cache(self, data_cache, loader, shape, dtype):
+        """
+        Let the data cache load the data when accessed and evict it when
+        over the memory budget.
+
+        :param data_cache: DataCache
+        :param loader: Function without arguments returning the data
+        :param shape: Shape of the data
+        :param dtype: Data type of the data
+        """
+        self._data = None
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._data_cache = data_cache
+        data_cache.register(self, loader)
 
     @property
     def wavelength(self):
@@ -128,3 +206,111 @@ class IFUCube(HasTraits):
     @wavelength.setter
     def wavelength(self, value):
         self._wavelength = value
+
+    @property
+    def celestial_wcs(self):
+        """
+        The 2D celestial WCS of the spaxels, from the wavelength model
+        if it has a WCS otherwise from the header.
+
+        :return: astropy.wcs.WCS
+        """
+        if hasattr(self.wavelength, 'wcs'):
+            return self.wavelength.wcs.celestial
+
+        with warnings.catch_warnings():
+            # Rebuilding the header from the dict warns about every HIERARCH keyword.
+            warnings.simplefilter('ignore', fits.verify.VerifyWarning)
+            return WCS(fits.Header(self.other_header)).celestial
+
+    @property
+    def dq(self):
+        return self._dq
+
+    @dq.setter
+    def dq(self, value):
+        if value is not None and self.shape is not None and value.shape != self.shape:
+            raise ValueError('DQ shape {} does not match data shape {}'.format(value.shape, self.shape))
+        self._dq = value
+
+    def mask(self, policy=None):
+        """
+        Bit-packed bad pixel mask derived from the DQ flags.
+
+        :param policy: DQPolicy, or None to use the policy of the DQ flags
+        :return: PackedMask, or None if there are no DQ flags
+        """
+        if self._dq is None:
+            return None
+
+        return self._dq.mask(policy)
+
+    @property
+    def error(self):
+        return self._error
+
+    @error.setter
+    def error(self, value):
+        if value is not None and self.shape is not None and value.shape != self.shape:
+            raise ValueError('Error shape {} does not match data shape {}'.format(value.shape, self.shape))
+        self._error = value
+
+    @property
+    def error_type(self):
+        return self._error_type
+
+    @error_type.setter
+    def error_type(self, value):
+        if value not in ERROR_TYPES:
+            raise ValueError('Unknown error type {}, expected one of {}'.format(value, ERROR_TYPES))
+        self._error_type = value
+
+    @property
+    def variance(self):
+        """Variance of the data computed from the error, or None."""
+        if self._error is None:
+            return None
+        return error_to_variance(self._error, self._error_type)
+
+    #
+    # Lazy arithmetic, see arithmetic.py
+    #
+
+    def lazy(self):
+        """
+        Start a lazy expression from this cube. Combining cubes with the
+        arithmetic operators builds the expression and evaluate() computes
+        it chunk by chunk::
+
+            result = ((cube_a - cube_b) / cube_c).evaluate()
+
+        :return: CubeExpression
+        """
+        return CubeTerm(self)
+
+    def __add__(self, other):
+        return self.lazy() + as_expression(other)
+
+    def __radd__(self, other):
+        return as_expression(other) + self.lazy()
+
+    def __sub__(self, other):
+        return self.lazy() - as_expression(other)
+
+    def __rsub__(self, other):
+        return as_expression(other) - self.lazy()
+
+    def __mul__(self, other):
+        return self.lazy() * as_expression(other)
+
+    def __rmul__(self, other):
+        return as_expression(other) * self.lazy()
+
+    def __truediv__(self, other):
+        return self.lazy() / as_expression(other)
+
+    def __rtruediv__(self, other):
+        return as_expression(other) / self.lazy()
+
+    def __neg__(self):
+        return -self.lazy()
@@ -2,6 +2,7 @@ import logging
 
 from astropy.io import fits
 
+from .datacache import DataCache, hdu_loader
 from .ifucube import IFUCube
 
 FORMAT = "%(levelname)-8s %(filename)-10s %(lineno)-3d %(funcName)-12s%(message)s"
@@ -14,22 +15,69 @@ class IFUList(list):
     """Container for IFUCube objects, but is just a list."""
 
     @classmethod
-    def read(cls, filename):
+    def read(cls, filename, memory_budget=None):
+        """
+        Read every 3D extension of the file as an IFUCube.
+
+        With a memory budget the data is not read up front, each cube loads
+        its data when accessed and the least recently used data is dropped
+        (and read again when needed) to stay within the budget.
+
+        :param filename:
+        :param memory_budget: Bytes (int or Quantity) of data to keep in memory, or a DataCache
+                              to share one budget between several lists
+        :return: IFUList
+        """
+
+        if memory_budget is None:
+            data_cache = None
+        elif isinstance(memory_budget, DataCache):
+            data_cache = memory_budget
+        else:
+            data_cache = DataCache(memory_budget)
 
         f = fits.open(filename)
 
         ifulist = []
 
         for hdui, hdu in enumerate(f):
-            if hasattr(hdu, 'data') and hdu.data is not None and len(hdu.data.shape) == 3:
-                cube = IFUCube.constructFromHDU(hdu)
+            if data_cache is None:
+                if hasattr(hdu, 'data') and hdu.data is not None and len(hdu.data.shape) == 3:
+                    cube = IFUCube.constructFromHDU(hdu)
+
+                    ifulist.append(cube)
+
+            # Only look at the header so the data is not read
+            elif hdu.header.get('NAXIS', 0) == 3:
+                cube = IFUCube.constructFromHDU(hdu, data_cache=data_cache,
+                                                data_loader=hdu_loader(filename, hdui))
 
                 ifulist.append(cube)
 
-        return cls(ifulist)
+        if data_cache is not None:
+            f.close()
+
+        ifulist = cls(ifulist)
+        ifulist.data_cache = data_cache
+
+        return ifulist
+
+    @property
+    def data_cache(self):
+        """DataCache of the cubes when read with a memory budget, otherwise None."""
+        return getattr(self, '_data_cache', None)
+
+    @data_cache.setter
+    def data_cache(self, value):
+        self._data_cache = value
+
+    @property
+    def stats(self):
+        """Hit, miss and eviction statistics of the data cache, or None."""
+        return self.data_cache.stats if self.data_cache is not None else None
 
     def __str__(self):
         return '[' + ', '.join(['{}. {}'.format(ii, x.__str__()) for ii, x in enumerate(self)]) + ']'
 
     def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.io import fits
+
+from ifucube.arithmetic import CubeExpression, error_to_variance
+from ifucube.dq import DQFlags
+from ifucube.ifucube import IFUCube
+from ifucube.ifucubelist import IFUList
+from ifucube.wavelength import Wavelength
+
+filename = 'ifucube/tests/data/data_cube.fits.gz'
+
+
+def make_cube(value, unit='erg/s', error=None, error_type='stddev', shape=(10, 3, 4), dq=None):
+    data = np.full(shape, value, dtype=np.float64)
+    if error is not None:
+        error = np.full(shape, error, dtype=np.float64)
+    return IFUCube('cube', data, unit, {}, Wavelength(), dq=dq, error=error, error_type=error_type)
+
+
+def test_lazy_expression():
+    a, b, c = make_cube(5.0), make_cube(3.0), make_cube(4.0)
+
+    expr = (a - b) / c
+    assert isinstance(expr, CubeExpression)
+    assert expr.shape == (10, 3, 4)
+
+    result = expr.evaluate(chunk_planes=3)
+    assert np.allclose(result.data, 0.5)
+    assert result.unit == u.dimensionless_unscaled
+    assert result.error is None
+
+    threaded = expr.evaluate(chunk_planes=2, threads=4)
+    assert np.array_equal(threaded.data, result.data)
+
+
+def test_variance_propagation():
+    a = make_cube(6.0, error=1.0)
+    b = make_cube(2.0, error=4.0, error_type='variance')
+
+    assert np.allclose((a + b).evaluate().variance, 5.0)
+    assert np.allclose((a * b).evaluate().variance, 2.0**2 * 1 + 6.0**2 * 4)
+    assert np.allclose((a / b).evaluate().variance, 1 / 2.0**2 + 6.0**2 * 4 / 2.0**4)
+    assert np.allclose((3 * a).evaluate().variance, 9.0)
+
+    ivar = make_cube(1.0, error=0.25, error_type='ivar')
+    assert np.allclose((ivar - a).evaluate().variance, 5.0)
+
+    with pytest.raises(ValueError):
+        error_to_variance(np.ones(3), 'sigma')
+
+
+def test_units():
+    a = make_cube(1.0, unit='erg/s')
+    b = make_cube(1.0, unit='J/s')
+
+    result = (a + b).evaluate()
+    assert result.unit == u.erg / u.s
+    assert np.allclose(result.data, 1 + 1e7)
+
+    assert (a * b).unit == u.erg * u.J / u.s**2
+    assert (a / (2 * u.s)).unit == u.erg / u.s**2
+
+    with pytest.raises(u.UnitConversionError):
+        a + make_cube(1.0, unit='m')
+
+
+def test_continuum_subtraction_and_calibration():
+    cube = make_cube(2.0, unit='count', error=1.0)
+    continuum = np.arange(10.0).reshape((10, 1, 1)) * u.count
+    sensitivity = np.full((10, 1, 1), 0.5) * u.erg / u.count
+
+    out = np.zeros(cube.data.shape)
+    result = ((cube - continuum) * sensitivity).evaluate(chunk_planes=4, out=out)
+
+    assert result.data is out
+    assert np.allclose(out[:, 0, 0], (2.0 - np.arange(10.0)) * 0.5)
+    assert result.unit == u.erg
+    assert np.allclose(result.variance, 0.25)
+
+
+def test_dq_masked_as_nan():
+    flags = np.zeros((10, 3, 4), dtype=np.uint16)
+    flags[4, 1, 2] = 1
+    a = make_cube(1.0, dq=DQFlags(flags))
+
+    result = (a + make_cube(1.0)).evaluate(chunk_planes=3)
+    assert np.isnan(result.data[4, 1, 2])
+    assert np.isnan(result.data).sum() == 1
+    assert a.data[4, 1, 2] == 1.0
+
+    b = make_cube(1.0, error=1.0, dq=DQFlags(flags))
+    result = (b + b).evaluate(chunk_planes=3)
+    assert np.isnan(result.variance[4, 1, 2])
+    assert np.isnan(result.variance).sum() == 1
+
+
+def test_result_header():
+    cube = make_cube(2.0)
+    cube.other_header = {'EXTNAME': 'FLUX', 'BUNIT': 'count', 'TELESCOP': 'X'}
+
+    header = (cube * (3 * u.erg / u.s)).evaluate().other_header
+    assert header['BUNIT'] == u.Unit('erg2 s-2').to_string('fits')
+    assert 'EXTNAME' not in header
+    assert header['TELESCOP'] == 'X'
+
+
+def test_scalars_keep_dtype():
+    cube = make_cube(1.0, error=1.0)
+    cube.data = cube.data.astype(np.float32)
+    cube.error = cube.error.astype(np.float32)
+
+    for expr in (cube * 2, 2.0 * cube, -cube, cube / 3 + 1 * u.erg / u.s):
+        result = expr.evaluate()
+        assert result.data.dtype == np.float32
+        assert result.error.dtype == np.float32
+
+    assert (cube * np.ones((10, 1, 1))).dtype == np.float64
+
+    # Scalars float32 cannot hold are computed in float64, not overflowed
+    with np.errstate(over='raise'):
+        result = (cube * 1e100).evaluate()
+    assert result.data.dtype == np.float64
+    assert np.allclose(result.data, 1e100)
+    assert np.allclose(result.variance, 1e200)
+
+
+def test_constructfromhdu_with_error():
+    hdulist = fits.open(filename)
+    cube = IFUCube.constructFromHDU(hdulist[1], error_hdu=hdulist[2])
+
+    assert cube.error.shape == cube.data.shape
+    assert np.allclose(cube.variance[100], hdulist[2].data[100].astype(np.float64)**2, rtol=1e-5, equal_nan=True)
+
+    ifulist = IFUList.read(filename)
+    result = (ifulist[0] - ifulist[0] / 2).evaluate(threads=2)
+    assert np.allclose(result.data, ifulist[0].data / 2, equal_nan=True)
@@ -0,0 +1,129 @@
+import os
+import shutil
+
+import pytest
+
+from ifucube.config_registry import ConfigRegistry, DEFAULT_DATA_CONFIGS, CUBEVIZ_DATA_CONFIGS, validate_config
+
+
+@pytest.fixture
+def no_env(monkeypatch):
+    monkeypatch.delenv(CUBEVIZ_DATA_CONFIGS, raising=False)
+
+
+def test_default_configurations(tmpdir, no_env):
+    registry = ConfigRegistry(cache_file=str(tmpdir.join('cache.json')))
+    configs = registry.configurations()
+
+    names = {cfg['name'] for cfg in configs}
+    assert 'muse' in names
+    assert 'jwst-fits-cube' in names
+    assert registry.parsed == len(configs)
+
+    muse = [cfg for cfg in configs if cfg['name'] == 'muse'][0]
+    assert muse['priority'] == 1200
+    assert muse['error_type'] == 'variance'
+
+    # Same registry, nothing parsed again
+    registry.configurations()
+    assert registry.parsed == len(configs)
+
+    # New registry (e.g. another worker) reads the on-disk cache
+    other = ConfigRegistry(cache_file=str(tmpdir.join('cache.json')))
+    assert other.configurations() == configs
+    assert other.parsed == 0
+
+
+def test_dedupe_and_invalidation(tmpdir, no_env, monkeypatch):
+    site = tmpdir.mkdir('site')
+    shutil.copy(os.path.join(DEFAULT_DATA_CONFIGS, 'muse.yaml'), str(site.join('muse-copy.yaml')))
+    os.symlink(str(site), str(tmpdir.join('link')))
+
+    registry = ConfigRegistry(cache_file=False)
+    monkeypatch.setenv(CUBEVIZ_DATA_CONFIGS, str(tmpdir.join('link')))
+    configs = registry.configurations([str(site)])
+
+    # The copy is found three times (command line, environment, default) but only kept once
+    assert len([cfg for cfg in configs if cfg['name'] == 'muse']) == 1
+    assert configs[0]['_config_file'] == os.path.realpath(str(site.join('muse-copy.yaml')))
+
+    # Touched but unchanged is not parsed again, a content change is
+    parsed = registry.parsed
+    os.utime(str(site.join('muse-copy.yaml')), ns=(0, 0))
+    registry.configurations([str(site)])
+    assert registry.parsed == parsed
+
+    with open(str(site.join('muse-copy.yaml')), 'a') as fp:
+        fp.write('\npriority: 5\n')
+    configs = registry.configurations([str(site)])
+    assert registry.parsed == parsed + 1
+    assert configs[0]['priority'] == 5
+
+
+def test_invalid_configurations_are_skipped(tmpdir, no_env):
+    site = tmpdir.mkdir('site')
+    site.join('broken.yaml').write('name: broken\ntype: BROKEN\nmatch:\n    all:\n        contains: 3\n')
+
+    registry = ConfigRegistry(cache_file=False)
+    configs = registry.configurations([str(site)])
+    assert 'broken' not in {cfg['name'] for cfg in configs}
+
+
+def test_invalid_dq_policy_does_not_stop_others(tmpdir, no_env):
+    site = tmpdir.mkdir('site')
+    site.join('a-broken.yaml').write('name: broken\ntype: BROKEN\nmatch:\n    all: {}\ndq_policy:\n    - 0\n')
+
+    cache_file = str(tmpdir.join('cache.json'))
+    configs = ConfigRegistry(cache_file=cache_file).configurations([str(site)])
+    names = {cfg['name'] for cfg in configs}
+    assert 'broken' not in names
+    assert 'muse' in names
+
+    # The invalid configuration was not cached either
+    with open(cache_file) as fp:
+        assert 'a-broken.yaml' not in fp.read()
+
+
+def test_configurations_json_cannot_hold(tmpdir, no_env):
+    site = tmpdir.mkdir('site')
+    site.join('dated.yaml').write('name: dated\ntype: DATED\ncreated: 2019-01-01\nmatch:\n    all: {}\n')
+    site.join('int-keys.yaml').write('name: int-keys\ntype: INT\nmatch:\n    all: {}\n'
+                                     'flux_unit_replacements:\n    1: erg\n')
+
+    cache_file = str(tmpdir.join('cache.json'))
+    registry = ConfigRegistry(cache_file=cache_file)
+    configs = {cfg['name']: cfg for cfg in registry.configurations([str(site)])}
+
+    assert str(configs['dated']['created']) == '2019-01-01'
+    assert configs['int-keys']['flux_unit_replacements'] == {1: 'erg'}
+    assert 'muse' in configs
+
+    # Only the others are cached on disk, and no temporary file is left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['cache.json', 'site']
+    other = ConfigRegistry(cache_file=cache_file)
+    assert {cfg['name']: cfg for cfg in other.configurations([str(site)])} == configs
+    assert other.parsed == 2
+
+    # Nothing JSON cannot hold escapes save()
+    registry._entries['extra'] = {'mtime': 0, 'size': 0, 'config': {'created': object()}}
+    registry._dirty = True
+    registry.save()
+    assert sorted(os.listdir(str(tmpdir))) == ['cache.json', 'site']
+
+
+def test_validate_config():
+    cfg = {'name': 'a', 'type': 'A', 'priority': 'high',
+           'match': {'all': {'equal': {'header_key': 'TELESCOP', 'value': 'X'}}}}
+    assert validate_config(cfg)['priority'] == 0
+
+    with pytest.raises(ValueError):
+        validate_config({'name': 'a', 'type': 'A'})
+
+    with pytest.raises(ValueError):
+        validate_config(dict(cfg, error_type='sigma'))
+
+    for dq_policy in ({'bad_bits': 'all'}, [0], {'bad_bits': [64]}, {'bad_bits': [-1]}, {'bad_bits': [True]}):
+        with pytest.raises(ValueError):
+            validate_config(dict(cfg, dq_policy=dq_policy))
+
+    assert validate_config(dict(cfg, dq_policy={'bad_bits': [0, 63]}))
@@ -0,0 +1,195 @@
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.io import fits
+
+from ifucube import datacache
+from ifucube.datacache import DataCache, hdu_dtype
+from ifucube.ifucubelist import IFUList
+
+filename = 'ifucube/tests/data/data_cube.fits.gz'
+
+# Each cube of the test file is 2048 x 17 x 17 float32
+CUBE_BYTES = 2048 * 17 * 17 * 4
+
+
+def test_read_with_memory_budget():
+    reference = IFUList.read(filename)
+    ifulist = IFUList.read(filename, memory_budget=1.5 * CUBE_BYTES)
+
+    assert len(ifulist) == 2
+    assert reference.stats is None
+
+    # Nothing is read up front
+    assert ifulist[0].shape == (2048, 17, 17)
+    assert ifulist.stats['misses'] == 0
+    assert str(ifulist[0]).startswith('IFUCube 018.DATA with data (2048, 17, 17)')
+
+    assert np.array_equal(ifulist[0].data, reference[0].data, equal_nan=True)
+    assert np.array_equal(ifulist[0].data, reference[0].data, equal_nan=True)
+    assert ifulist.stats['misses'] == 1
+    assert ifulist.stats['hits'] == 1
+
+    # Only one cube fits in the budget
+    assert np.array_equal(ifulist[1].data, reference[1].data, equal_nan=True)
+    assert ifulist.stats['evictions'] == 1
+    assert ifulist.stats['nbytes'] == CUBE_BYTES
+    assert not ifulist.data_cache.is_loaded(ifulist[0])
+
+    # Reloaded transparently
+    assert np.array_equal(ifulist[0].data, reference[0].data, equal_nan=True)
+    assert ifulist.stats['misses'] == 3
+    assert ifulist.stats['evictions'] == 2
+
+
+def test_shared_budget_and_explicit_data():
+    data_cache = DataCache(10 * u.MB)
+    first = IFUList.read(filename, memory_budget=data_cache)
+    second = IFUList.read(filename, memory_budget=data_cache)
+
+    assert first.data_cache is second.data_cache
+    for cube in first + second:
+        cube.data
+
+    assert data_cache.stats['loaded'] == 4
+    assert data_cache.nbytes == 4 * CUBE_BYTES
+
+    # Setting the data takes the cube out of the cache
+    first[0].data = np.zeros((1, 2, 3))
+    assert first[0].data_cache is None
+    assert first[0].shape == (1, 2, 3)
+    assert data_cache.stats['loaded'] == 3
+
+
+def test_lazy_arithmetic_with_budget():
+    ifulist = IFUList.read(filename, memory_budget=CUBE_BYTES)
+    expr = ifulist[0] - ifulist[1]
+    assert ifulist.stats['misses'] == 0
+
+    assert expr.dtype == np.float32
+    assert ifulist.stats['misses'] == 0
+
+    result = expr.evaluate(chunk_planes=64, threads=2)
+    reference = IFUList.read(filename)
+    assert np.allclose(result.data, reference[0].data - reference[1].data, equal_nan=True)
+
+    # Each operand is read once, the pins only let the budget be exceeded while evaluating
+    assert ifulist.stats['misses'] == 2
+    assert ifulist.stats['pinned'] == 0
+    assert ifulist.stats['nbytes'] <= CUBE_BYTES
+
+
+class Cube:
+    pass
+
+
+def test_load_does_not_block_other_threads():
+    data_cache = DataCache(10 * u.MB)
+    loaded, slow = Cube(), Cube()
+
+    release = threading.Event()
+
+    def slow_loader():
+        assert release.wait(5)
+        return np.zeros(10)
+
+    data_cache.register(loaded, lambda: np.ones(10))
+    data_cache.register(slow, slow_loader)
+    data_cache.get(loaded)
+
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(data_cache.get(slow))) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+
+    # A hit while the slow cube is being read
+    assert data_cache.get(loaded).sum() == 10
+    release.set()
+    for reader in readers:
+        reader.join(5)
+
+    assert len(results) == 3
+    assert data_cache.stats['misses'] == 2
+
+
+def test_waiting_thread_finds_stored_data(monkeypatch):
+    data_cache = DataCache(10 * u.MB)
+    cube = Cube()
+
+    reading, waiting, woken, waiter_done = (threading.Event() for _ in range(4))
+
+    class SignallingEvent(threading.Event):
+        def wait(self, timeout=None):
+            waiting.set()
+            return super().wait(timeout)
+
+        def set(self):
+            super().set()
+            woken.set()
+
+    class PausingLock:
+        # Once the waiting thread is woken, let it run before the reading
+        # thread takes the lock again.
+        def __init__(self, lock):
+            self._lock = lock
+
+        def __enter__(self):
+            return self._lock.__enter__()
+
+        def __exit__(self, *exc_info):
+            self._lock.__exit__(*exc_info)
+            if woken.is_set() and threading.current_thread() is threads[0]:
+                waiter_done.wait(0.5)
+
+    monkeypatch.setattr(datacache, 'threading', SimpleNamespace(Event=SignallingEvent))
+    monkeypatch.setattr(data_cache, '_lock', PausingLock(data_cache._lock))
+
+    def loader():
+        # Only finish reading once the other thread waits for this read.
+        reading.set()
+        assert waiting.wait(5)
+        return np.zeros(1000)
+
+    data_cache.register(cube, loader)
+
+    results = []
+
+    def get():
+        results.append(data_cache.get(cube))
+
+    def get_after_read_started():
+        assert reading.wait(5)
+        get()
+        waiter_done.set()
+
+    threads = [threading.Thread(target=get), threading.Thread(target=get_after_read_started)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 2
+    assert data_cache.stats['misses'] == 1
+    assert data_cache.stats['hits'] == 1
+    assert data_cache.nbytes == 8000
+
+    data_cache.clear()
+    assert data_cache.nbytes == 0
+
+
+def test_hdu_dtype():
+    for dtype in (np.uint8, np.int8, np.int16, np.uint16, np.int32, np.uint32, np.float32, np.float64):
+        hdu = fits.ImageHDU(np.arange(6, dtype=dtype).reshape((1, 2, 3)))
+        assert hdu_dtype(hdu.header) == hdu.data.dtype
+
+    hdu = fits.ImageHDU(np.arange(6, dtype=np.int16))
+    hdu.header['BSCALE'] = 0.5
+    assert hdu_dtype(hdu.header) == np.float32
+
+
+def test_invalid_budget():
+    with pytest.raises(ValueError):
+        DataCache(0)
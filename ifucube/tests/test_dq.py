@@ -0,0 +1,102 @@
+import gc
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ifucube.dq import DQFlags, DQPolicy, DQMaskCache, PackedMask
+from ifucube.ifucube import IFUCube
+from ifucube.wavelength import Wavelength
+
+
+def make_flags(shape=(5, 3, 7), dtype='>i4'):
+    rng = np.random.RandomState(42)
+    return rng.randint(0, 16, size=shape).astype(dtype)
+
+
+def test_packed_mask_roundtrip():
+    mask = make_flags() > 10
+    packed = PackedMask(mask)
+
+    assert packed.shape == mask.shape
+    assert packed.nbytes == (mask.size + 7) // 8
+    assert np.array_equal(packed.unpack(), mask)
+    assert np.array_equal(np.asarray(packed), mask)
+    assert packed.count() == mask.sum()
+
+    data = np.ones(mask.shape, dtype=np.float32)
+    applied = packed.apply(data)
+    assert np.isnan(applied[mask]).all()
+    assert (applied[~mask] == 1).all()
+    assert packed.masked(data).sum() == (~mask).sum()
+
+
+def test_flags_native_dtype_and_policy():
+    raw = make_flags()
+    hdu = fits.ImageHDU(raw, name='DQ')
+    flags = DQFlags.constructFromHDU(hdu, policy=DQPolicy('jwst', [0]))
+
+    assert flags.dtype.isnative
+    assert np.issubdtype(flags.dtype, np.integer)
+    assert flags.name == 'DQ'
+
+    assert np.array_equal(flags.bad(), (raw & 1) != 0)
+    assert np.array_equal(flags.bad(DQPolicy('any')), raw != 0)
+    assert np.array_equal(flags.bad(DQPolicy('hi', [2, 3])), (raw & 12) != 0)
+
+    with pytest.raises(TypeError):
+        DQFlags(raw.astype(float))
+
+    with pytest.raises(ValueError):
+        DQPolicy('bad', [64])
+
+
+def test_policy_from_config():
+    assert DQPolicy.constructFromConfig('muse', None).bitmask is None
+    assert DQPolicy.constructFromConfig('jwst', {'bad_bits': [0, 2]}).bitmask == 5
+    assert DQPolicy('a', [1, 0]) == DQPolicy('a', [0, 1])
+
+
+def test_mask_cache_eviction():
+    cache = DQMaskCache(max_entries=2)
+    flags = DQFlags(make_flags())
+    policies = [DQPolicy('p', [b]) for b in range(3)]
+
+    first = cache.get(flags, policies[0])
+    assert cache.get(flags, policies[0]) is first
+    cache.get(flags, policies[1])
+    cache.get(flags, policies[2])
+    assert len(cache) == 2
+    assert cache.get(flags, policies[0]) is not first
+
+    del flags
+    gc.collect()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_cube_mask():
+    raw = make_flags()
+    cube = IFUCube('SCI', np.zeros(raw.shape), '', {}, Wavelength(), dq=DQFlags(raw))
+
+    assert cube.mask() is cube.mask()
+    assert np.array_equal(cube.mask().unpack(), raw != 0)
+    assert IFUCube('SCI', np.zeros(raw.shape), '', {}, Wavelength()).mask() is None
+
+    with pytest.raises(ValueError):
+        IFUCube('SCI', np.zeros((1, 2, 3)), '', {}, Wavelength(), dq=DQFlags(raw))
+
+
+def test_flags_read_only():
+    raw = np.zeros((2, 3, 4), dtype=np.uint8)
+    flags = DQFlags(raw)
+
+    assert flags.mask().count() == 0
+
+    with pytest.raises(ValueError):
+        flags.flags[0, 0, 0] = 1
+
+    # The caller's array is copied, changing it does not affect the flags
+    raw[0, 0, 0] = 1
+    assert flags.mask().count() == 0
+    assert DQFlags(raw).mask().count() == 1
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.wcs import WCS
+
+from ifucube.footprint import Footprint, FootprintIndex
+from ifucube.ifucubelist import IFUList
+
+filename = 'ifucube/tests/data/data_cube.fits.gz'
+
+
+def make_wcs(ra, dec, scale=0.2 / 3600, shape=(20, 30)):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(shape[1] + 1) / 2, (shape[0] + 1) / 2]
+    wcs.wcs.cdelt = [-scale, scale]
+    return wcs
+
+
+def test_index_ifulist():
+    ifulist = IFUList.read(filename)
+    index = FootprintIndex.constructFromIFUList(ifulist)
+    assert len(index) == 2
+
+    wcs = ifulist[0].celestial_wcs
+    ra, dec = wcs.wcs_pix2world([[5, 3]], 0)[0]
+
+    matches = index.query_cone(ra * u.deg, dec * u.deg)
+    assert sorted(m.key for m in matches) == [0, 1]
+    assert matches[0].spaxels.tolist() == [[3, 5]]
+
+    assert index.query_cone(ra + 1, dec, 1 / 3600) == []
+
+
+def test_cone_and_box():
+    index = FootprintIndex()
+    index.add(Footprint('a', make_wcs(10.0, 20.0), (20, 30)))
+    index.add(Footprint('b', make_wcs(10.0 + 2 / 3600, 20.0), (20, 30)))
+    index.add(Footprint('far', make_wcs(200.0, -30.0), (20, 30)))
+    index.add(Footprint('wrap', make_wcs(359.9999, 0.0), (20, 30)))
+
+    matches = {m.key: m.spaxels for m in index.query_cone(10.0, 20.0, 0.5 / 3600)}
+    assert set(matches) == {'a', 'b'}
+
+    ra, dec = index['a'].wcs.wcs_pix2world(matches['a'][:, 1], matches['a'][:, 0], 0)
+    assert (np.hypot((ra - 10.0) * np.cos(np.radians(20.0)), dec - 20.0) <= 0.5 / 3600 + 1e-9).all()
+    assert len(matches['a']) > 1
+
+    box = {m.key: m.spaxels for m in index.query_box(10.0, 10.0 + 1 / 3600, 20.0, 20.0 + 1 / 3600)}
+    assert set(box) == {'a', 'b'}
+    assert len(box['a']) == 25
+
+    # Box through ra = 0
+    assert [m.key for m in index.query_box(359.999, 0.001, -0.001, 0.001)] == ['wrap']
+    assert [m.key for m in index.query_cone(0.0, 0.0, 1 / 3600)] == ['wrap']
+
+    # The whole sky, and wide boxes bigger than a hemisphere
+    everything = {m.key: m.spaxels for m in index.query_box(0, 360, -90, 90)}
+    assert set(everything) == {'a', 'b', 'far', 'wrap'}
+    assert all(len(spaxels) == 20 * 30 for spaxels in everything.values())
+    assert {m.key for m in index.query_box(-180, 180, -90, 90)} == set(everything)
+    assert [m.key for m in index.query_box(100, 300, -40, -20)] == ['far']
+    assert {m.key for m in index.query_box(300, 100, -10, 30)} == {'a', 'b', 'wrap'}
+
+
+def test_large_cone():
+    index = FootprintIndex()
+    index.add(Footprint('a', make_wcs(10.0, 20.0, shape=(20, 30)), (20, 30)))
+
+    # Far from the footprint the projection stretches distances, the cone still contains it.
+    for radius in (38, 41, 90):
+        matches = index.query_cone(50.0, 20.0, radius)
+        assert [m.key for m in matches] == ['a']
+        assert len(matches[0].spaxels) == 20 * 30
+
+    # More than 90 degrees away, where the projection is undefined
+    matches = index.query_cone(190.0, -10.0, 175)
+    assert [m.key for m in matches] == ['a']
+    assert len(matches[0].spaxels) == 20 * 30
+
+    # Cones reaching part of the footprint from off the grid
+    matches = index.query_cone(10.0, 20.0 - 30.0, 30.0)
+    assert [m.key for m in matches] == ['a']
+    assert 0 < len(matches[0].spaxels) < 20 * 30
+    assert index.query_cone(190.0, -20.0, 100) == []
+
+
+def test_incremental_and_persist(tmpdir):
+    index = FootprintIndex()
+    index.add(Footprint(('night1.fits', 1), make_wcs(150.0, 2.0), (20, 30)))
+    index.add(Footprint(('night1.fits', 2), make_wcs(150.0, 2.0), (20, 30)))
+
+    assert len(index.query_cone(150.0, 2.0)) == 2
+    index.remove(('night1.fits', 2))
+    assert [m.key for m in index.query_cone(150.0, 2.0)] == [('night1.fits', 1)]
+
+    filename = str(tmpdir.join('footprints.json'))
+    index.save(filename)
+    other = FootprintIndex.read(filename)
+
+    assert ('night1.fits', 1) in other
+    assert other[('night1.fits', 1)].center == pytest.approx(index[('night1.fits', 1)].center)
+    assert [m.key for m in other.query_cone(150.0, 2.0)] == [('night1.fits', 1)]
+
+
+def test_pole():
+    index = FootprintIndex()
+    index.add(Footprint('pole', make_wcs(0.0, 90.0), (20, 30)))
+
+    assert [m.key for m in index.query_cone(123.0, 90.0 - 0.5 / 3600, 1 / 3600)] == ['pole']
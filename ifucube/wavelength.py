@@ -53,6 +53,10 @@ class WavelengthLinearModel(Wavelength):
             ))
             raise e
 
+    @property
+    def wcs(self):
+        return self._wcs
+
     def __call__(self, *args, **kwargs):
         """
         Going to assume at this point that 3 points are passed in.